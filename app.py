@@ -1,18 +1,31 @@
 from flask import Flask, render_template, send_from_directory, request, jsonify, session, redirect, url_for
 import os
 import json
+import math
 import random
 import base64
+import sys
 import time
+import threading
+import subprocess
 from datetime import datetime
 from functools import wraps
 from collections import deque
+import compact_store
+from compact_store import (RatingsTable, load_song_catalog, file_signature,
+                           read_json_with_signature, rebuild_snapshot)
+from rate_limit import TokenBucketLimiter, RecentEventWindow
 try:
     from mutagen.mp3 import MP3
     from mutagen.id3 import ID3NoHeaderError, APIC
     MUTAGEN_AVAILABLE = True
 except ImportError:
     MUTAGEN_AVAILABLE = False
+try:
+    from recommend import ItemSimilarity
+    RECOMMENDATIONS_AVAILABLE = True
+except ImportError:
+    RECOMMENDATIONS_AVAILABLE = False
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'javier_radio_secret_key_2024')
@@ -24,11 +37,30 @@ SONG_DATA_FILE = 'song_data.json'
 # Activity tracking
 recent_activities = deque(maxlen=100)
 RATINGS_DATA_FILE = 'ratings_data.json'
+RATINGS_SNAPSHOT_FILE = 'ratings_data.bin'
+
+# Compact read-only views, reloaded when the underlying file changes
+_ratings_table_cache = {'signature': None, 'table': None}
+_ratings_table_lock = threading.Lock()
+_song_catalog_cache = {'signature': None, 'catalog': None}
+_recommender_cache = {'engine': None}
+
+# Rebuild work that runs off the request path, one thread per job name
+_background_jobs = {}
+_background_jobs_lock = threading.Lock()
+_snapshot_process = {'process': None}
 
 
 # Admin configuration
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
 
+# Write endpoint protection: every play/rate rewrites a JSON file
+write_limiter = TokenBucketLimiter(
+    rate=float(os.environ.get('WRITE_RATE_PER_SECOND', '0.5')),
+    burst=int(os.environ.get('WRITE_RATE_BURST', '10'))
+)
+recent_plays = RecentEventWindow(window=float(os.environ.get('PLAY_DEDUP_SECONDS', '30')))
+
 # Initialize data files
 def initialize_data_files():
     """Initialize data files if they don't exist"""
@@ -59,6 +91,35 @@ def timestamp_to_date_filter(timestamp):
 
 initialize_data_files()
 
+# JSON file helpers
+def write_json_atomic(path, data):
+    """Write a JSON file via a temporary file so readers never see a partial write.
+
+    Returns the signature the file has once it is in place.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            st = os.fstat(f.fileno())
+        os.replace(tmp_path, path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def run_in_background(name, target, *args):
+    """Start target in a daemon thread unless a job with the same name is still running"""
+    with _background_jobs_lock:
+        thread = _background_jobs.get(name)
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        _background_jobs[name] = thread
+        thread.start()
+
 # Rating management functions
 def load_ratings_data():
     """Load ratings data from JSON file"""
@@ -69,18 +130,62 @@ def load_ratings_data():
         return {}
 
 def save_ratings_data(ratings_data):
-    """Save ratings data to JSON file"""
+    """Save ratings data to JSON file, returning the written file's signature or None"""
     try:
-        with open(RATINGS_DATA_FILE, 'w') as f:
-            json.dump(ratings_data, f, indent=2)
-        return True
+        signature = write_json_atomic(RATINGS_DATA_FILE, ratings_data)
+        rebuild_ratings_snapshot_in_background()
+        return signature
     except Exception as e:
         print(f"Error saving ratings data: {e}")
-        return False
+        return None
+
+def rebuild_ratings_snapshot_in_background():
+    """Rebuild the shared ratings snapshot in a child process.
+
+    Parsing ratings_data.json holds the GIL for the whole file, so doing it
+    on a thread would still stall every request in this worker.
+    """
+    with _background_jobs_lock:
+        process = _snapshot_process['process']
+        if process is not None and process.poll() is None:
+            return
+        try:
+            _snapshot_process['process'] = subprocess.Popen(
+                [sys.executable, compact_store.__file__, RATINGS_DATA_FILE, RATINGS_SNAPSHOT_FILE])
+        except OSError as e:
+            print(f"Error starting ratings snapshot rebuild: {e}")
+
+def get_ratings_table():
+    """Get the memory-mapped ratings table, refreshing a stale snapshot in the background"""
+    with _ratings_table_lock:
+        table = _ratings_table_cache['table']
+        snapshot_signature = file_signature(RATINGS_SNAPSHOT_FILE)
+        if table is None and snapshot_signature is None:
+            # First start with no snapshot at all: there is nothing to serve yet
+            rebuild_snapshot(RATINGS_DATA_FILE, RATINGS_SNAPSHOT_FILE, blocking=True)
+            snapshot_signature = file_signature(RATINGS_SNAPSHOT_FILE)
+
+        if table is None or _ratings_table_cache['signature'] != snapshot_signature:
+            try:
+                table = RatingsTable.open(RATINGS_SNAPSHOT_FILE)
+            except (OSError, ValueError) as e:
+                print(f"Error opening ratings snapshot: {e}")
+                if table is None:
+                    table = RatingsTable.from_ratings_data({})
+            _ratings_table_cache['signature'] = snapshot_signature
+            _ratings_table_cache['table'] = table
+
+    # Keep serving this table until the rebuilt snapshot is ready
+    if table.source_signature != file_signature(RATINGS_DATA_FILE):
+        rebuild_ratings_snapshot_in_background()
+    return table
 
 def add_song_rating(song_key, rating, user_id=None):
     """Add a rating for a song"""
-    ratings_data = load_ratings_data()
+    try:
+        ratings_data, loaded_signature = read_json_with_signature(RATINGS_DATA_FILE)
+    except (FileNotFoundError, json.JSONDecodeError):
+        ratings_data, loaded_signature = {}, None
 
     if song_key not in ratings_data:
         ratings_data[song_key] = {
@@ -118,18 +223,47 @@ def add_song_rating(song_key, rating, user_id=None):
     ratings_data[song_key]['total_ratings'] = len(ratings_list)
     ratings_data[song_key]['average_rating'] = sum(ratings_list) / len(ratings_list) if ratings_list else 0.0
 
-    save_ratings_data(ratings_data)
+    saved_signature = save_ratings_data(ratings_data)
+
+    # Patch the similarity matrix in place; the engine only adopts a snapshot
+    # of exactly the file version written here, otherwise it is rebuilt
+    engine = _recommender_cache['engine']
+    if saved_signature is not None and engine is not None:
+        try:
+            engine.add_rating(song_key, user_id, rating_entry['rating'],
+                              loaded_signature, saved_signature)
+        except Exception as e:
+            print(f"Error updating recommendations: {e}")
+            _recommender_cache['engine'] = None
     return ratings_data[song_key]
 
+def _build_recommender(table):
+    """Build a fresh similarity engine and swap it in once it is ready"""
+    try:
+        _recommender_cache['engine'] = ItemSimilarity(table)
+    except Exception as e:
+        print(f"Error building recommendations: {e}")
+
+def get_recommender():
+    """Get the item similarity engine, rebuilding it in the background when it falls behind.
+
+    Returns None until the first engine has been built.
+    """
+    if not RECOMMENDATIONS_AVAILABLE:
+        return None
+    table = get_ratings_table()
+    engine = _recommender_cache['engine']
+    if engine is None or (engine.table is not table and not engine.adopt(table)):
+        # Keep serving the current engine until the new one is ready
+        run_in_background('recommender', _build_recommender, table)
+    return engine
+
 def get_song_rating_info(song_key):
-    """Get rating information for a specific song"""
-    ratings_data = load_ratings_data()
-    if song_key in ratings_data:
-        return ratings_data[song_key]
+    """Get rating totals for a specific song"""
+    total_ratings, average_rating = get_ratings_table().song_summary(song_key)
     return {
-        'ratings': [],
-        'total_ratings': 0,
-        'average_rating': 0.0
+        'total_ratings': total_ratings,
+        'average_rating': average_rating
     }
 
 def get_user_rating(song_key, user_id=None):
@@ -137,12 +271,7 @@ def get_user_rating(song_key, user_id=None):
     if user_id is None:
         user_id = request.remote_addr if request else 'anonymous'
 
-    ratings_data = load_ratings_data()
-    if song_key in ratings_data:
-        for rating_entry in ratings_data[song_key]['ratings']:
-            if rating_entry['user_id'] == user_id:
-                return rating_entry['rating']
-    return 0
+    return get_ratings_table().user_rating(song_key, user_id)
 
 # Template filters
 @app.template_filter('timestamp_to_date')
@@ -223,10 +352,26 @@ def load_song_data():
 def save_song_data(data):
     """Save song data to JSON file"""
     try:
-        with open(SONG_DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        write_json_atomic(SONG_DATA_FILE, data)
+        return True
     except Exception as e:
         print(f"Error saving song data: {e}")
+        return False
+
+def get_song_catalog():
+    """Get the song catalog as SongRecord objects, reloaded when the file changes"""
+    catalog = _song_catalog_cache['catalog']
+    if catalog is None or _song_catalog_cache['signature'] != file_signature(SONG_DATA_FILE):
+        try:
+            data, signature = read_json_with_signature(SONG_DATA_FILE)
+            catalog = load_song_catalog(data if isinstance(data, dict) else {})
+            _song_catalog_cache['catalog'] = catalog
+            _song_catalog_cache['signature'] = signature
+        except (OSError, ValueError) as e:
+            print(f"Error loading song catalog: {e}")
+            if catalog is None:
+                catalog = {}
+    return catalog
 
 def initialize_song_data():
     """Initialize song data for all MP3 files in javiradio directory"""
@@ -275,6 +420,18 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Rate limiting decorator for endpoints that write to disk
+def rate_limited(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        retry_after = write_limiter.consume(request.remote_addr or 'anonymous')
+        if retry_after:
+            response = jsonify({'success': False, 'error': 'Too many requests, please slow down'})
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            return response, 429
+        return f(*args, **kwargs)
+    return decorated_function
+
 # Routes
 @app.route('/')
 def index():
@@ -292,14 +449,15 @@ def shae_page():
 def get_songs():
     """Get list of all songs"""
     try:
-        songs = load_song_data()
+        songs = get_song_catalog()
         if not songs:
-            songs = initialize_song_data()
+            initialize_song_data()
+            songs = get_song_catalog()
 
         song_list = []
         for key, song in songs.items():
             # Validate required fields
-            if not all(field in song for field in ['title', 'duration', 'play_count', 'filename']):
+            if song.title is None or song.filename is None:
                 continue
 
             # Get rating information for this song
@@ -307,15 +465,15 @@ def get_songs():
 
             song_list.append({
                 'key': key,
-                'title': song['title'],
-                'artist': song.get('artist', 'JaviRadio Collection'),
-                'duration': int(song['duration']) if song['duration'] else 0,
-                'play_count': int(song['play_count']) if song['play_count'] else 0,
-                'formatted_duration': f"{int(song['duration'])//60}:{int(song['duration'])%60:02d}" if song['duration'] else "0:00",
-                'url': f"/static/javiradio/{song['filename']}",
+                'title': song.title,
+                'artist': song.artist or 'JaviRadio Collection',
+                'duration': int(song.duration) if song.duration else 0,
+                'play_count': int(song.play_count) if song.play_count else 0,
+                'formatted_duration': f"{int(song.duration)//60}:{int(song.duration)%60:02d}" if song.duration else "0:00",
+                'url': f"/static/javiradio/{song.filename}",
                 'average_rating': float(round(rating_info['average_rating'], 1)),
                 'total_ratings': rating_info['total_ratings'],
-                'album_art': song.get('album_art', None)
+                'album_art': song.album_art
             })
 
         return jsonify(song_list)
@@ -324,14 +482,29 @@ def get_songs():
         return jsonify([])
 
 @app.route('/api/play/<song_key>')
+@rate_limited
 def play_song(song_key):
     """Play a song and increment play count"""
+    # Coalesce repeated plays of the same song from the same client; the claim
+    # is taken before any file I/O so concurrent duplicates are caught too
+    play_event = (request.remote_addr or 'anonymous', song_key)
+    if not recent_plays.claim(play_event):
+        catalog = get_song_catalog()
+        if song_key in catalog:
+            return jsonify({
+                'success': True,
+                'song': catalog[song_key].to_dict(),
+                'play_count': catalog[song_key].play_count
+            })
+        return jsonify({'success': False, 'error': 'Song not found'}), 404
+
     try:
         songs = load_song_data()
 
         if song_key in songs:
             songs[song_key]['play_count'] += 1
-            save_song_data(songs)
+            if not save_song_data(songs):
+                recent_plays.release(play_event)
 
             # Track activity
             add_activity(song_key, songs[song_key]['title'])
@@ -342,8 +515,10 @@ def play_song(song_key):
                 'play_count': songs[song_key]['play_count']
             })
 
+        recent_plays.release(play_event)
         return jsonify({'success': False, 'error': 'Song not found'}), 404
     except Exception as e:
+        recent_plays.release(play_event)
         print(f"Error playing song {song_key}: {e}")
         return jsonify({'success': False, 'error': 'Internal server error'}), 500
 
@@ -351,11 +526,11 @@ def play_song(song_key):
 def get_stats():
     """Get radio statistics"""
     try:
-        songs = load_song_data()
-        ratings_data = load_ratings_data()
+        songs = get_song_catalog()
+        ratings_table = get_ratings_table()
 
-        total_plays = sum(int(song.get('play_count', 0)) for song in songs.values())
-        total_listen_time = sum(int(song.get('total_listen_time', 0)) for song in songs.values())
+        total_plays = sum(int(song.play_count or 0) for song in songs.values())
+        total_listen_time = sum(int(song.total_listen_time or 0) for song in songs.values())
 
         # Calculate rating statistics
         total_ratings = 0
@@ -363,19 +538,18 @@ def get_stats():
         rated_songs = 0
 
         for song_key in songs.keys():
-            if song_key in ratings_data:
-                song_ratings = ratings_data[song_key]
-                if song_ratings['total_ratings'] > 0:
-                    total_ratings += song_ratings['total_ratings']
-                    total_rating_sum += song_ratings['average_rating'] * song_ratings['total_ratings']
-                    rated_songs += 1
+            song_total, song_average = ratings_table.song_summary(song_key)
+            if song_total > 0:
+                total_ratings += song_total
+                total_rating_sum += song_average * song_total
+                rated_songs += 1
 
         overall_average_rating = (total_rating_sum / total_ratings) if total_ratings > 0 else 0
 
         # Get top songs
         song_list = [(k, v) for k, v in songs.items()]
-        song_list.sort(key=lambda x: int(x[1].get('play_count', 0)), reverse=True)
-        top_songs = [{'title': v.get('title', k), 'plays': int(v.get('play_count', 0))} for k, v in song_list[:5]]
+        song_list.sort(key=lambda x: int(x[1].play_count or 0), reverse=True)
+        top_songs = [{'title': v.title or k, 'plays': int(v.play_count or 0)} for k, v in song_list[:5]]
 
         # Format listen time
         hours = total_listen_time // 3600
@@ -421,6 +595,7 @@ def get_visitor_count_api():
 
 
 @app.route('/api/rate/<song_key>', methods=['POST'])
+@rate_limited
 def rate_song(song_key):
     """Submit a rating for a song"""
     try:
@@ -509,25 +684,18 @@ def get_song_rating(song_key):
 def get_all_ratings():
     """Get rating information for all songs"""
     try:
-        ratings_data = load_ratings_data()
-        songs_data = load_song_data()
+        ratings_table = get_ratings_table()
+        songs_data = get_song_catalog()
         result = {}
 
         # Include ratings for all songs, even those without ratings yet
-        for song_key in songs_data.keys():
-            if song_key in ratings_data:
-                rating_info = ratings_data[song_key]
-                result[song_key] = {
-                    'average_rating': float(round(rating_info.get('average_rating', 0), 1)),
-                    'total_ratings': rating_info['total_ratings'],
-                    'song_title': songs_data[song_key].get('title', song_key)
-                }
-            else:
-                result[song_key] = {
-                    'average_rating': 0.0,
-                    'total_ratings': 0,
-                    'song_title': songs_data[song_key].get('title', song_key)
-                }
+        for song_key, song in songs_data.items():
+            total_ratings, average_rating = ratings_table.song_summary(song_key)
+            result[song_key] = {
+                'average_rating': float(round(average_rating, 1)),
+                'total_ratings': total_ratings,
+                'song_title': song.title or song_key
+            }
 
         return jsonify({
             'ratings': result,
@@ -544,6 +712,56 @@ def get_all_ratings():
             'error': 'Failed to load ratings data'
         }), 500
 
+@app.route('/api/recommendations/<song_key>')
+def get_recommendations(song_key):
+    """Get songs to play next, ranked by rating similarity with popular songs as fallback"""
+    try:
+        songs = get_song_catalog()
+        if song_key not in songs:
+            return jsonify({'song_key': song_key, 'recommendations': [], 'error': 'Song not found'}), 404
+
+        limit = max(1, min(request.args.get('limit', 5, type=int), 20))
+
+        scored = []
+        engine = get_recommender()
+        if engine is not None:
+            scored = [(key, score) for key, score in engine.similar(song_key, limit * 2)
+                      if key in songs][:limit]
+
+        # Fill remaining slots with the most played songs
+        if len(scored) < limit:
+            chosen = {key for key, _ in scored}
+            chosen.add(song_key)
+            popular = sorted((k for k in songs if k not in chosen),
+                             key=lambda k: int(songs[k].play_count or 0), reverse=True)
+            scored += [(key, 0.0) for key in popular[:limit - len(scored)]]
+
+        recommendations = []
+        for key, score in scored:
+            song = songs[key]
+            recommendations.append({
+                'key': key,
+                'title': song.title or key,
+                'artist': song.artist or 'JaviRadio Collection',
+                'url': f"/static/javiradio/{song.filename}",
+                'play_count': int(song.play_count or 0),
+                'similarity': round(score, 3),
+                'album_art': song.album_art
+            })
+
+        return jsonify({
+            'song_key': song_key,
+            'recommendations': recommendations
+        })
+
+    except Exception as e:
+        print(f"Error getting recommendations for {song_key}: {e}")
+        return jsonify({
+            'song_key': song_key,
+            'recommendations': [],
+            'error': 'Failed to load recommendations'
+        }), 500
+
 # Admin routes
 @app.route('/admin/login', methods=['GET'])
 def admin_login_page():
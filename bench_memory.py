@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory benchmark: ratings_data.json dict layout vs. the compact RatingsTable
+
+Usage: python bench_memory.py [--ratings 300000] [--users 100000] [--songs 50]
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from compact_store import RatingsTable
+
+
+def generate_ratings_json(num_ratings, num_users, num_songs, seed=0):
+    """Generate synthetic ratings data in the ratings_data.json layout"""
+    rng = random.Random(seed)
+    ratings_data = {}
+    now = time.time()
+    seen = set()
+    while len(seen) < num_ratings:
+        song_key = f"song-{rng.randrange(num_songs)}"
+        user_id = f"203.0.{rng.randrange(num_users) // 256}.{rng.randrange(256)}"
+        if (song_key, user_id) in seen:
+            continue
+        seen.add((song_key, user_id))
+        song = ratings_data.setdefault(song_key, {'ratings': [], 'total_ratings': 0, 'average_rating': 0.0})
+        song['ratings'].append({
+            'user_id': user_id,
+            'rating': rng.randint(1, 5),
+            'timestamp': now - rng.random() * 86400 * 365
+        })
+    for song in ratings_data.values():
+        ratings_list = [r['rating'] for r in song['ratings']]
+        song['total_ratings'] = len(ratings_list)
+        song['average_rating'] = sum(ratings_list) / len(ratings_list)
+    return json.dumps(ratings_data)
+
+
+def measure(build):
+    """Return (result, bytes retained by result) for a zero-argument builder"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ratings', type=int, default=300000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--songs', type=int, default=50)
+    args = parser.parse_args()
+
+    raw = generate_ratings_json(args.ratings, args.users, args.songs)
+
+    # Both builders start from the raw JSON text so every string they keep is counted
+    ratings_data, dict_bytes = measure(lambda: json.loads(raw))
+    del ratings_data
+    table, array_bytes = measure(lambda: RatingsTable.from_ratings_data(json.loads(raw)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, 'ratings_data.bin')
+        table.write(snapshot_path)
+        del table
+
+        mapped, mapped_bytes = measure(lambda: RatingsTable.open(snapshot_path))
+        mapped_file_bytes = os.path.getsize(snapshot_path)
+        num_mapped = len(mapped)
+        del mapped
+
+    print(f"ratings: {args.ratings:,}  users: {args.users:,}  songs: {args.songs}")
+    print(f"{'layout':<28}{'private heap':>16}{'shared (mmap)':>16}")
+    print(f"{'dict of dicts (json)':<28}{dict_bytes / 1e6:>14.2f}MB{'-':>16}")
+    print(f"{'RatingsTable (arrays)':<28}{array_bytes / 1e6:>14.2f}MB{'-':>16}")
+    print(f"{'RatingsTable (mmap)':<28}{mapped_bytes / 1e6:>14.2f}MB{mapped_file_bytes / 1e6:>14.2f}MB")
+    print(f"ratings in mapped table: {num_mapped:,}")
+
+
+if __name__ == '__main__':
+    main()
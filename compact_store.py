@@ -0,0 +1,303 @@
+"""
+Compact in-memory representation of the song catalog and ratings data.
+
+The JSON files remain the source of truth. This module provides a
+read-optimised view of them: songs become ``__slots__`` records, and
+ratings are flattened into parallel typed arrays that are written to a
+binary snapshot and memory-mapped, so every worker shares the same pages.
+
+This reduces steady-state memory per worker, not peak memory: building a
+snapshot still parses the whole JSON file into the dict layout first, so
+the app runs it as a separate process:
+
+    python compact_store.py ratings_data.json ratings_data.bin
+"""
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from bisect import bisect_left
+from itertools import accumulate, chain, repeat
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+SNAPSHOT_MAGIC = b'JSRT'
+SNAPSHOT_VERSION = 2
+
+# magic, version, song count, user count, rating count, song key blob length,
+# user id blob length, then the (inode, size, mtime_ns) of the source JSON
+_HEADER = struct.Struct('=4sIIIIQQQQq')
+
+
+class SongRecord:
+    """A single catalog entry"""
+
+    __slots__ = ('key', 'title', 'artist', 'filename', 'duration', 'play_count',
+                 'total_listen_time', 'last_played', 'album_art', 'lyrics', 'fields')
+
+    def __init__(self, key, data):
+        self.key = sys.intern(key)
+        # Which fields the JSON entry actually had, so to_dict can round-trip it
+        self.fields = tuple(sys.intern(name) for name in self.__slots__[1:-1] if name in data)
+        self.title = data.get('title')
+        artist = data.get('artist')
+        self.artist = sys.intern(artist) if isinstance(artist, str) else artist
+        self.filename = data.get('filename')
+        self.duration = data.get('duration')
+        self.play_count = data.get('play_count')
+        self.total_listen_time = data.get('total_listen_time')
+        self.last_played = data.get('last_played')
+        self.album_art = data.get('album_art')
+        self.lyrics = data.get('lyrics')
+
+    def to_dict(self):
+        """Return the record in the song_data.json layout"""
+        return {name: getattr(self, name) for name in self.fields}
+
+
+def load_song_catalog(song_data):
+    """Convert a song data dict into a dict of SongRecord objects"""
+    return {sys.intern(key): SongRecord(key, song) for key, song in song_data.items()
+            if isinstance(song, dict)}
+
+
+def _pad8(n):
+    return (n + 7) & ~7
+
+
+class StringColumn:
+    """Sequence of strings packed into one UTF-8 blob, indexed by offsets"""
+
+    __slots__ = ('offsets', 'blob')
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = array.array('I', accumulate(map(len, encoded), initial=0))
+        return cls(offsets, b''.join(encoded))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def get(self, i):
+        return self[i].decode('utf-8')
+
+
+class RatingsTable:
+    """Ratings stored as parallel typed arrays, grouped by song.
+
+    Ratings for song ``i`` occupy ``offsets[i]:offsets[i + 1]`` in every
+    array and are sorted by user index within that range. User ids are
+    kept sorted, so a user's index is found by bisecting ``users``.
+    """
+
+    def __init__(self, song_keys, users, offsets, song_idx, user_idx, rating, timestamp,
+                 source_signature=None, buffer=None):
+        self.song_keys = song_keys
+        self.song_index = {key: i for i, key in enumerate(song_keys)}
+        self.users = users
+        self.offsets = offsets
+        self.song_idx = song_idx
+        self.user_idx = user_idx
+        self.rating = rating
+        self.timestamp = timestamp
+        self.source_signature = source_signature
+        self._buffer = buffer  # keeps the mmap alive for the views above
+        self._summaries = {}
+
+    def __len__(self):
+        return len(self.rating)
+
+    @property
+    def n_users(self):
+        return len(self.users)
+
+    def find_user(self, user_id):
+        """Return the index of a user id, or None if it has no ratings"""
+        key = str(user_id).encode('utf-8')
+        pos = bisect_left(self.users, key)
+        if pos < len(self.users) and self.users[pos] == key:
+            return pos
+        return None
+
+    @classmethod
+    def from_ratings_data(cls, ratings_data, source_signature=None):
+        """Build a table from the ratings_data.json layout"""
+        song_keys = [sys.intern(key) for key in ratings_data]
+        per_song = [ratings_data[key].get('ratings', []) for key in song_keys]
+        counts = [len(entries) for entries in per_song]
+        offsets = array.array('I', accumulate(counts, initial=0))
+        entries = list(chain.from_iterable(per_song))
+
+        # Code point order matches UTF-8 byte order, so this is also the blob order
+        raw_users = [str(entry['user_id']) for entry in entries]
+        user_ids = sorted(set(raw_users))
+        rank = {user_id: i for i, user_id in enumerate(user_ids)}
+        user_column = list(map(rank.__getitem__, raw_users))
+
+        order = list(chain.from_iterable(
+            sorted(range(offsets[i], offsets[i + 1]), key=user_column.__getitem__)
+            for i in range(len(song_keys))
+        ))
+        ordered = [entries[j] for j in order]
+
+        song_idx = array.array('I', chain.from_iterable(repeat(i, n) for i, n in enumerate(counts)))
+        user_idx = array.array('I', map(user_column.__getitem__, order))
+        rating = array.array('B', [int(entry['rating']) for entry in ordered])
+        timestamp = array.array('d', [float(entry.get('timestamp', 0.0)) for entry in ordered])
+
+        return cls(song_keys, StringColumn.from_strings(user_ids), offsets, song_idx, user_idx,
+                   rating, timestamp, source_signature=source_signature)
+
+    def write(self, path):
+        """Atomically write the table to a binary snapshot file"""
+        songs = StringColumn.from_strings(self.song_keys)
+        ino, size, mtime_ns = self.source_signature or (0, 0, 0)
+        header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self.song_keys), self.n_users,
+                              len(self.rating), len(songs.blob), len(self.users.blob),
+                              ino, size, mtime_ns)
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(b'\0' * (_pad8(len(header)) - len(header)))
+            # 8-byte columns first so every section stays naturally aligned
+            for column in (self.timestamp, self.offsets, self.song_idx, self.user_idx,
+                           songs.offsets, self.users.offsets, self.rating):
+                f.write(bytes(column))
+            f.write(songs.blob)
+            f.write(self.users.blob)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map a snapshot file read-only"""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(buffer)
+        (magic, version, n_songs, n_users, n_ratings, songs_len, users_len,
+         ino, size, mtime_ns) = _HEADER.unpack_from(view)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported ratings snapshot: {path}")
+
+        pos = _pad8(_HEADER.size)
+
+        def section(fmt, count):
+            nonlocal pos
+            size = struct.calcsize(fmt) * count
+            column = view[pos:pos + size].cast(fmt)
+            pos += size
+            return column
+
+        timestamp = section('d', n_ratings)
+        offsets = section('I', n_songs + 1)
+        song_idx = section('I', n_ratings)
+        user_idx = section('I', n_ratings)
+        song_offsets = section('I', n_songs + 1)
+        user_offsets = section('I', n_users + 1)
+        rating = section('B', n_ratings)
+        song_blob = section('B', songs_len)
+        user_blob = section('B', users_len)
+
+        # Song keys are few and used as dict keys everywhere, so decode them;
+        # user ids stay in the shared mapping
+        songs = StringColumn(song_offsets, song_blob)
+        song_keys = [sys.intern(songs.get(i)) for i in range(n_songs)]
+        return cls(song_keys, StringColumn(user_offsets, user_blob), offsets, song_idx, user_idx,
+                   rating, timestamp, source_signature=(ino, size, mtime_ns), buffer=buffer)
+
+    def song_summary(self, song_key):
+        """Return (total_ratings, average_rating) for a song"""
+        summary = self._summaries.get(song_key)
+        if summary is None:
+            i = self.song_index.get(song_key)
+            if i is None:
+                return 0, 0.0
+            start, end = self.offsets[i], self.offsets[i + 1]
+            total = end - start
+            summary = (total, sum(self.rating[start:end]) / total if total else 0.0)
+            self._summaries[song_key] = summary
+        return summary
+
+    def user_rating(self, song_key, user_id):
+        """Return a user's rating for a song, or 0 if they haven't rated it"""
+        i = self.song_index.get(song_key)
+        u = self.find_user(user_id)
+        if i is None or u is None:
+            return 0
+        start, end = self.offsets[i], self.offsets[i + 1]
+        pos = bisect_left(self.user_idx, u, start, end)
+        if pos < end and self.user_idx[pos] == u:
+            return self.rating[pos]
+        return 0
+
+
+def file_signature(path):
+    """Identify a file version by inode, size and modification time"""
+    try:
+        st = os.stat(path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+
+def read_json_with_signature(path):
+    """Read a JSON file along with the signature of the version that was read"""
+    with open(path, 'r') as f:
+        st = os.fstat(f.fileno())
+        return json.load(f), (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def rebuild_snapshot(json_path, snapshot_path, blocking=False):
+    """Rebuild a ratings snapshot from its JSON source if it is out of date.
+
+    Only one process rebuilds at a time; with blocking=False the others
+    return immediately and keep serving the snapshot they already have.
+    """
+    with open(f"{snapshot_path}.lock", 'a') as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+
+        # Another process may have finished a rebuild while we waited for the lock
+        try:
+            if RatingsTable.open(snapshot_path).source_signature == file_signature(json_path):
+                return True
+        except (OSError, ValueError):
+            pass
+
+        try:
+            ratings_data, source_signature = read_json_with_signature(json_path)
+        except (OSError, ValueError) as e:
+            # Never replace a good snapshot with one built from a failed read
+            print(f"Error reading ratings data for snapshot: {e}")
+            return False
+
+        try:
+            RatingsTable.from_ratings_data(ratings_data, source_signature).write(snapshot_path)
+            return True
+        except Exception as e:
+            print(f"Error writing ratings snapshot: {e}")
+            return False
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(f"Usage: {sys.argv[0]} RATINGS_JSON SNAPSHOT")
+    sys.exit(0 if rebuild_snapshot(sys.argv[1], sys.argv[2]) else 1)
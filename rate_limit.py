@@ -0,0 +1,82 @@
+"""
+In-process rate limiting for the write endpoints.
+
+Both structures hold a bounded number of entries in an OrderedDict used as
+an LRU, so memory stays constant no matter how many clients show up.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """Token bucket per client key, with least-recently-used buckets evicted"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        if not rate > 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        if not burst >= 1:
+            raise ValueError(f"Token bucket burst must be at least 1, got {burst}")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, now=None):
+        """Take one token for key. Returns 0 if allowed, else seconds until a token is available"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+class RecentEventWindow:
+    """Remembers recent events so repeats within a time window can be coalesced"""
+
+    def __init__(self, window, max_entries=10000):
+        self.window = float(window)
+        self.max_entries = max_entries
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # Entries are kept in insertion order, so expired ones sit at the front
+        while self._events:
+            oldest_time = next(iter(self._events.values()))
+            if now - oldest_time < self.window:
+                break
+            self._events.popitem(last=False)
+
+    def claim(self, key, now=None):
+        """Open a window for key. Returns False if one is already open"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._events:
+                return False
+            self._events[key] = now
+            if len(self._events) > self.max_entries:
+                self._events.popitem(last=False)
+            return True
+
+    def release(self, key):
+        """Drop the window for key, e.g. when the claimed event did not happen"""
+        with self._lock:
+            self._events.pop(key, None)
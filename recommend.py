@@ -0,0 +1,166 @@
+"""
+Item-item song recommendations from the ratings matrix.
+
+Similarity is the cosine between song columns of the (user x song) rating
+matrix. The matrix is never materialised: the song x song Gram matrix
+R^T R is accumulated from each user's co-rated song pairs with vectorised
+NumPy operations, then patched in place as individual ratings come in.
+"""
+
+import threading
+from bisect import bisect_left
+
+import numpy as np
+
+# Upper bound on co-rating pairs materialised at once while building
+PAIR_CHUNK = 1 << 22
+
+
+def _gram_matrix(song_idx, user_idx, rating, n_songs):
+    """Compute R^T R as a sum of per-user outer products, in O(sum of degree^2)"""
+    gram = np.zeros(n_songs * n_songs)
+    if len(rating) == 0:
+        return gram.reshape(n_songs, n_songs)
+
+    order = np.argsort(user_idx, kind='stable')
+    users = user_idx[order]
+    songs = song_idx[order].astype(np.int64)
+    values = rating[order]
+
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    degrees = np.diff(np.r_[starts, len(users)])
+    pair_ends = np.cumsum(degrees * degrees)
+
+    first = 0
+    while first < len(starts):
+        done = pair_ends[first - 1] if first else 0
+        last = max(first + 1, int(np.searchsorted(pair_ends, done + PAIR_CHUNK, side='right')))
+        group_starts = starts[first:last]
+        group_degrees = degrees[first:last]
+
+        # Pair every rating with each rating of the same user: "left" walks the
+        # chunk's ratings repeated once per co-rating, "right" walks the user's
+        # ratings for each of them
+        position_degrees = np.repeat(group_degrees, group_degrees)
+        positions = np.arange(group_starts[0], group_starts[-1] + group_degrees[-1])
+        left = np.repeat(positions, position_degrees)
+        pair_offsets = np.arange(len(left)) - np.repeat(np.cumsum(position_degrees) - position_degrees,
+                                                        position_degrees)
+        right = np.repeat(np.repeat(group_starts, group_degrees), position_degrees) + pair_offsets
+
+        gram += np.bincount(songs[left] * n_songs + songs[right],
+                            weights=values[left] * values[right], minlength=n_songs * n_songs)
+        first = last
+
+    return gram.reshape(n_songs, n_songs)
+
+
+class ItemSimilarity:
+    """Song-to-song cosine similarity, updated incrementally.
+
+    The engine tracks the (inode, size, mtime_ns) signature of the ratings
+    JSON its matrix reflects. Each add_rating names the file version it
+    was based on and the version it produced, so adopt() can tell whether
+    a new snapshot holds exactly the ratings already applied.
+    """
+
+    def __init__(self, table):
+        self._lock = threading.Lock()
+        self.rebuild(table)
+
+    def _attach(self, table):
+        """Point the engine at a table's columns and clear pending ratings"""
+        self.table = table
+        self.song_keys = list(table.song_keys)
+        self.song_index = dict(table.song_index)
+        self._signature = table.source_signature
+        self._diverged = False
+        self._pending = {}
+
+    def rebuild(self, table):
+        """Recompute the Gram matrix from a RatingsTable"""
+        gram = _gram_matrix(np.frombuffer(table.song_idx, dtype=np.uint32),
+                            np.frombuffer(table.user_idx, dtype=np.uint32),
+                            np.frombuffer(table.rating, dtype=np.uint8).astype(np.float64),
+                            len(table.song_keys))
+        with self._lock:
+            self._attach(table)
+            self._gram = gram
+            self._cache = {}
+
+    def adopt(self, table):
+        """Switch to a newer snapshot if it matches the ratings applied so far.
+
+        Returns False when the matrix is missing ratings written elsewhere;
+        the caller should then build a fresh engine.
+        """
+        with self._lock:
+            if self._diverged or table.source_signature != self._signature:
+                return False
+            self._attach(table)
+            return True
+
+    def _user_vector(self, user_id):
+        """Dense vector of a user's current ratings across all songs"""
+        vector = np.zeros(len(self.song_keys))
+        u = self.table.find_user(user_id)
+        if u is not None:
+            # Each song's ratings are sorted by user, so bisect per song
+            offsets, user_idx, rating = self.table.offsets, self.table.user_idx, self.table.rating
+            for i in range(len(self.table.song_keys)):
+                start, end = offsets[i], offsets[i + 1]
+                pos = bisect_left(user_idx, u, start, end)
+                if pos < end and user_idx[pos] == u:
+                    vector[i] = rating[pos]
+        for (pending_user, song_key), value in self._pending.items():
+            if pending_user == user_id:
+                vector[self.song_index[song_key]] = value
+        return vector
+
+    def add_rating(self, song_key, user_id, rating, base_signature, new_signature):
+        """Apply a rating saved by rewriting ratings JSON version base_signature as new_signature"""
+        with self._lock:
+            if self._diverged or base_signature != self._signature:
+                # The save included ratings this matrix never saw
+                self._diverged = True
+                return
+            self._signature = new_signature
+
+            s = self.song_index.get(song_key)
+            if s is None:
+                s = len(self.song_keys)
+                self.song_keys.append(song_key)
+                self.song_index[song_key] = s
+                self._gram = np.pad(self._gram, ((0, 1), (0, 1)))
+
+            vector = self._user_vector(user_id)
+            delta = float(rating) - vector[s]
+            if delta:
+                # Row and column s both gain delta * (user's ratings); the
+                # diagonal needs rating^2 - old^2, hence the extra delta^2
+                self._gram[s] += delta * vector
+                self._gram[:, s] += delta * vector
+                self._gram[s, s] += delta * delta
+
+                stale = set(np.nonzero(self._gram[:, s])[0].tolist())
+                stale.add(s)
+                for i in stale:
+                    self._cache.pop(self.song_keys[i], None)
+            self._pending[(user_id, song_key)] = float(rating)
+
+    def similar(self, song_key, limit=10):
+        """Return [(song_key, score), ...] for the most similar songs"""
+        with self._lock:
+            cached = self._cache.get(song_key)
+            if cached is None:
+                s = self.song_index.get(song_key)
+                if s is None:
+                    return []
+                norms = np.sqrt(np.diag(self._gram))
+                denom = norms * norms[s]
+                scores = np.divide(self._gram[s], denom, out=np.zeros_like(denom), where=denom > 0)
+                scores[s] = 0
+                order = np.argsort(-scores, kind='stable')
+                cached = [(self.song_keys[i], float(scores[i])) for i in order if scores[i] > 0]
+                self._cache[song_key] = cached
+            return cached[:limit]